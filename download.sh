@@ -34,7 +34,8 @@ metafile=".import-${language}-meta"
 commfile=".import-${language}-comm"
 pagefile=".import-${language}-page"
 userfile=".import-${language}-user"
-markfile=".import-${language}-mark" # stores marks used by git fast-import
+hashfile=".import-${language}-hash" # stores object ids of the blobs
+markfile=".import-${language}-mark" # stores commit marks used by git fast-import
 progfile=".import-${language}-prog" # stores last file completed
 
 #
@@ -67,14 +68,14 @@ echo ""
 echo "Importing into git"
 
 if [[ ! -e ${progfile} ]] ; then
-    echo "Progress file ${profile} not found, starting anew."
-    rm -rf ${markfile} ${metafile} ${commfile} ${userfile} ${pagefile}
+    echo "Progress file ${progfile} not found, starting anew."
+    rm -rf ${markfile} ${metafile} ${commfile} ${userfile} ${pagefile} ${hashfile}
     rm -rf ${repo}
     git init --bare ${repo}
     touch ${progfile}
 else
     echo "*************************************************************"
-    echo "*      Found old progress file ${profile}, resuming.        *"
+    echo "*      Found old progress file ${progfile}, resuming.        *"
     echo "* Ctrl-C and remove ${progfile} if this was not your intent *"
     echo "*************************************************************"
     for each in $(seq 5 1); do
@@ -88,7 +89,7 @@ fi
 while IFS=" " read sum fn; do
     if ! grep -q "^${fn}$" ${progfile}; then
         #
-        # extract | levitate | import
+        # extract | levitate (runs git fast-import)
         #
         7z -so x ${dumpdir}/${fn} \
             | ./levitation.py -w -m -1 --only-blobs \
@@ -96,9 +97,8 @@ while IFS=" " read sum fn; do
                 --commfile=${commfile} \
                 --userfile=${userfile} \
                 --pagefile=${pagefile} \
-            | GIT_DIR=${repo} git fast-import \
-                --import-marks-if-exists=${markfile} \
-                --export-marks=${markfile} \
+                --hashfile=${hashfile} \
+                --git-dir=${repo} \
             && echo ${fn} >> ${progfile}
     fi
 done < ${dumpdir}/md5sums
@@ -109,7 +109,9 @@ done < ${dumpdir}/md5sums
         --commfile=${commfile} \
         --userfile=${userfile} \
         --pagefile=${pagefile} \
-    | GIT_DIR=${repo} git fast-import --import-marks=${marksfile}
+        --hashfile=${hashfile} \
+        --markfile=${markfile} \
+        --git-dir=${repo}
 
 # let git clean up a few bytes now that we're done.
 GIT_DIR=${repo} git gc
@@ -3,20 +3,33 @@
 import xml.dom.minidom
 import base64
 from calendar import timegm
+import collections
+import concurrent.futures
+import copy
 import datetime
+import hashlib
+import heapq
+import io
+import json
 import os
 import os.path
 import re
 import socket
 import struct
+import subprocess
+import tempfile
 import codecs
 import sys
 import time
 import urllib.parse
 import ipaddress
 import itertools
+import multiprocessing
 import pickle
+import queue
+import threading
 import unicodedata
+import zlib
 from optparse import OptionParser
 
 # The encoding for input, output and internal representation. Leave alone.
@@ -24,6 +37,22 @@ ENCODING = 'UTF-8'
 # The XML namespace we support.
 XMLNS = 'http://www.mediawiki.org/xml/export-0.10/'
 MAX_INT64 = 0xFFFFFFFFFFFFFFFF
+# How many of the latest commit phase checkpoints to remember.
+CHECKPOINTS_KEPT = 16
+# Mark of the blob written after each checkpoint, far above the marks of
+# revisions, commits and uploads.
+CHECKPOINT_MARK = 1 << 40
+# The Committer of a --jobs worker process, see init_segment_worker.
+SEGMENT_COMMITTER = None
+# Serializes writes to the output, which the blob pipeline does from several
+# threads.
+OUTPUT_LOCK = threading.RLock()
+# Where the output goes, if not to stdout. Set while levitation runs git
+# fast-import itself.
+OUTPUT = None
+# Set for --prescan, --plan and --verify, whose output is a report for
+# people, not a stream for fast-import.
+REPORT = False
 
 
 def tzoffset():
@@ -51,15 +80,31 @@ def singletext(node):
 
 
 def bytes_out(text):
-    sys.stdout.buffer.write(text)
+    with OUTPUT_LOCK:
+        if OUTPUT:
+            OUTPUT.write(text)
+        else:
+            sys.stdout.buffer.write(text)
 
 
 def out(text):
     bytes_out(bytes(text, ENCODING))
 
 
+def flush_out():
+    with OUTPUT_LOCK:
+        if OUTPUT:
+            OUTPUT.flush()
+        else:
+            sys.stdout.buffer.flush()
+
+
 def progress(text):
-    out('progress ' + text + '\n')
+    # The --plan steps write into a CountingOutput, like into fast-import.
+    if REPORT and not OUTPUT:
+        print(text)
+    else:
+        out('progress ' + text + '\n')
 
 
 def open_file(fn):
@@ -106,6 +151,113 @@ def upload_mark(upload_number):
     return get_mark(2, upload_number)
 
 
+def parse_size(text):
+    """Return a size like '512M' or '4g' in bytes. No suffix means bytes."""
+    text = text.strip().upper().rstrip('B')
+    factor = 1
+    for i, suffix in enumerate('KMGT'):
+        if text.endswith(suffix):
+            factor = 1024 ** (i + 1)
+            text = text[:-1]
+    return int(float(text) * factor)
+
+
+class MemoryGovernor:
+    """Keeps the memory use of levitation below --memory-limit.
+
+    Components holding memory that grows with the dump (the --sort buffer, the
+    blob pipeline queues, the prefetch ring, the --jobs segments) register
+    themselves with a callable returning their size in bytes and one making
+    them smaller, which returns the bytes it freed. They call tick regularly.
+    Once the resident set size of the process exceeds the limit, the largest
+    components are shrunk until the excess is freed.
+
+    The limit covers this process only, not git fast-import or --jobs
+    workers. Sizes are estimates, and freed memory does not always go back to
+    the system right away, so leave some headroom.
+
+    Attributes:
+      limit: int, the limit in bytes, or 0 for no limit.
+      components: dict, mapping component names to (size, shrink) callables.
+      shrinks: collections.Counter, number of shrinks per component name.
+      peak: int, highest resident set size seen, in bytes.
+    """
+
+    # Check the resident set size every this many ticks.
+    TICKS = 1000
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.components = {}
+        self.shrinks = collections.Counter()
+        self.peak = 0
+        self.ticks = 0
+        self.lock = threading.Lock()
+
+    def register(self, name, size, shrink):
+        with self.lock:
+            self.components[name] = (size, shrink)
+
+    def unregister(self, name):
+        with self.lock:
+            self.components.pop(name, None)
+
+    def tracked(self):
+        """Return the summed size of all components, in bytes."""
+        with self.lock:
+            components = list(self.components.values())
+        return sum(size() for size, _shrink in components)
+
+    def rss(self):
+        """Return the resident set size of this process, in bytes.
+
+        Falls back to the tracked sizes where /proc is not available.
+        """
+        try:
+            with open('/proc/self/statm', 'rb') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return self.tracked()
+
+    def tick(self):
+        """Count an item handled by a component, check now and then."""
+        if self.limit <= 0:
+            return
+        self.ticks += 1
+        if self.ticks % self.TICKS == 0:
+            self.check()
+
+    def check(self):
+        """Shrink the largest components while the process is over the limit."""
+        if self.limit <= 0:
+            return
+        used = self.rss()
+        self.peak = max(self.peak, used)
+        excess = used - self.limit
+        if excess <= 0:
+            return
+
+        with self.lock:
+            components = list(self.components.items())
+        components.sort(key=lambda c: c[1][0](), reverse=True)
+        for name, (size, shrink) in components:
+            if excess <= 0:
+                break
+            freed = shrink()
+            if freed:
+                self.shrinks[name] += 1
+                excess -= freed
+
+    def report(self):
+        if self.limit <= 0:
+            return
+        self.peak = max(self.peak, self.rss())
+        progress('memory: peak resident set %d MiB of %d MiB limit' % (
+            self.peak >> 20, self.limit >> 20))
+        for name, count in sorted(self.shrinks.items()):
+            progress('memory: shrunk %s %d times' % (name, count))
+
+
 class MetaStore:
     def __init__(self, file):
         # L: The revision id
@@ -143,9 +295,13 @@ class MetaStore:
         self.fh.seek(rev * self.struct.size, os.SEEK_SET)
         self.fh.write(data)
 
+    def close(self):
+        self.fh.close()
+
     def read(self, rev):
-        self.fh.seek(rev * self.struct.size)
-        data = self.fh.read(self.struct.size)
+        # pread doesn't move the file position, so reads can come from several
+        # threads. It bypasses the write buffer, though.
+        data = os.pread(self.fh.fileno(), self.struct.size, rev * self.struct.size)
 
         if len(data) < self.struct.size:
             return None
@@ -206,6 +362,11 @@ class StringStore:
 
         self.fh = open_file(file)
 
+    def count(self):
+        """Return the number of entries the store has room for."""
+        self.fh.seek(0, os.SEEK_END)
+        return self.fh.tell() // self.struct.size
+
     def write(self, id, text, flags = 1):
         ba = bytes(text, ENCODING)
         if len(ba) > 255:
@@ -226,8 +387,8 @@ class StringStore:
         self.fh.write(data)
 
     def read(self, id):
-        self.fh.seek(id * self.struct.size)
-        packed = self.fh.read(self.struct.size)
+        # See MetaStore.read.
+        packed = os.pread(self.fh.fileno(), self.struct.size, id * self.struct.size)
         data = None
 
         if len(packed) < self.struct.size:
@@ -243,12 +404,136 @@ class StringStore:
 
         return d
 
+    def close(self):
+        self.fh.close()
+
+
+class HashStore:
+    """Store for the git object id and size of each revision's blob.
+
+    The commit step references blobs by their object id, so neither step needs
+    git fast-import marks for blobs.
+    """
+
+    def __init__(self, file):
+        # 20s: The SHA-1 of the blob
+        # Q: The size of the blob
+        self.struct = struct.Struct('=20sQ')
+
+        self.fh = open_file(file)
+
+    def write(self, id, contents):
+        sha = hashlib.sha1(b'blob %d\0' % len(contents))
+        sha.update(contents)
+
+        self.fh.seek(id * self.struct.size)
+        self.fh.write(self.struct.pack(sha.digest(), len(contents)))
+
+    def read(self, id):
+        # See MetaStore.read.
+        data = os.pread(self.fh.fileno(), self.struct.size, id * self.struct.size)
+
+        if len(data) < self.struct.size:
+            return None
+
+        data = self.struct.unpack(data)
+        if data[0] == bytes(20):
+            # Never written, or written by a version that used marks.
+            return None
+
+        return {'sha': data[0].hex(), 'size': data[1]}
+
+    def close(self):
+        self.fh.close()
+
+
+class PageIndex:
+    """Index from page ids to the revisions of that page.
+
+    The index is a linked list spread over two fixed-width files. The first one
+    maps a page id to the highest revision id seen for that page, the second one
+    maps each revision id to the previous revision id of the same page. A zero
+    entry ends the chain, which is fine since MediaWiki ids start at 1.
+
+    Both files are filled in a single sequential pass over a MetaStore, so the
+    index can be built after the fact from the stores of a full import. The
+    size and modification time of the MetaStore it was built from are kept in
+    a third file, so an index missing revisions added later can be told.
+    """
+
+    def __init__(self, file):
+        # L: a revision id
+        self.struct = struct.Struct('=L')
+
+        self.head = open_file(file)
+        self.prev = open_file(file + '-prev')
+        self.stampfile = file + '-stamp'
+
+    def stamp(self, store):
+        st = os.fstat(store.fh.fileno())
+        return (st.st_size, st.st_mtime_ns)
+
+    def stale(self, store):
+        """Return whether the index has to be built (again) from store."""
+        try:
+            with open(self.stampfile, 'rb') as f:
+                return pickle.load(f) != self.stamp(store)
+        except (FileNotFoundError, EOFError):
+            return True
+
+    def _read(self, fh, id):
+        fh.seek(id * self.struct.size)
+        data = fh.read(self.struct.size)
+
+        if len(data) < self.struct.size:
+            return 0
+
+        return self.struct.unpack(data)[0]
+
+    def _write(self, fh, id, value):
+        fh.seek(id * self.struct.size)
+        fh.write(self.struct.pack(value))
+
+    def build(self, store):
+        """Fill the index from all existing records of a MetaStore."""
+        for fh in (self.head, self.prev):
+            fh.seek(0)
+            fh.truncate(0)
+
+        for index in itertools.count(start=0, step=1):
+            info = store.read(index)
+            if not info:
+                break
+            if info['exists']:
+                self._write(self.prev, info['rev'], self._read(self.head, info['page']))
+                self._write(self.head, info['page'], info['rev'])
+
+        self.head.flush()
+        self.prev.flush()
+        with open(self.stampfile, 'wb') as f:
+            pickle.dump(self.stamp(store), f)
+
+    def revisions(self, page):
+        """Return the revision ids of a page, highest first."""
+        revs = []
+        rev = self._read(self.head, page)
+        while rev:
+            revs.append(rev)
+            rev = self._read(self.prev, rev)
+
+        return revs
+
+    def close(self):
+        self.head.close()
+        self.prev.close()
+
 
 class User:
     def __init__(self, node, meta):
         self.id = 0
         self.name = None
         self.isip = self.isdel = False
+        self.meta = meta
 
         if node.hasAttribute('deleted') and node.getAttribute('deleted') == 'deleted':
             self.isdel = True
@@ -265,18 +550,34 @@ class User:
                 self.isip = True
                 self.id = int(ipaddress.ip_address(singletext(lv1)))
 
+    def save(self):
         if not (self.isip or self.isdel):
-            meta['user'].write(self.id, self.name)
+            self.meta['user'].write(self.id, self.name)
 
 
 class Revision:
-    def __init__(self, node, page, meta, upload=False):
+    """A revision or upload, parsed from its DOM.
+
+    Parsing happens on construction. Writing the metadata to the stores and
+    writing the blob to the output are separate steps, see write_meta and
+    write_blob, so that they can run on different threads.
+
+    With --single-pass nothing is stored, and write_blob writes a commit with
+    the content inline instead of a blob.
+
+    While waiting for write_blob, the contents can be moved to a temporary
+    file with spill, to keep big revisions out of memory.
+    """
+
+    def __init__(self, node, page, meta, upload=False, title=None):
         self.minor = False
         self.timestamp = self.contents = self.comment = self.user = None
+        self.spilled = None
         self.page = page
         self.meta = meta
-        self.dom = node
         self.upload = upload
+        # (namespace id, title) of the page, for --single-pass.
+        self.title = title
 
         if self.upload:
             self.id = self.meta['max_upload'] + 1
@@ -284,7 +585,7 @@ class Revision:
         else:
             self.id = 0
 
-        for lv1 in self.dom.childNodes:
+        for lv1 in node.childNodes:
             if lv1.nodeType != lv1.ELEMENT_NODE:
                 continue
 
@@ -303,22 +604,81 @@ class Revision:
             elif lv1.tagName == 'contents':
                 self.contents = base64.b64decode(singletext(lv1))
 
+    def write_meta(self):
+        if self.meta['options'].SINGLE_PASS:
+            return
+
         if self.upload:
             store = self.meta['uplo']
             comm = self.meta['upco']
-            mark = upload_mark(self.id)
+            hashes = self.meta['uphs']
         else:
             store = self.meta['meta']
             comm = self.meta['comm']
-            mark = revision_mark(self.id)
+            hashes = self.meta['hash']
 
+        self.user.save()
         store.write(self.id, self.timestamp, self.page, self.user, self.minor, self.upload)
+        hashes.write(self.id, self.contents)
         if self.comment:
             comm.write(self.id, self.comment)
 
-        out('blob\nmark :{}\ndata {}\n'.format(mark, len(self.contents)))
-        bytes_out(self.contents)
+    def size(self):
+        """Return the size of the contents in memory, in bytes."""
+        return len(self.contents) if self.contents else 0
+
+    def spill(self):
+        """Move the contents to a temporary file until they are written."""
+        self.spilled = tempfile.TemporaryFile()
+        self.spilled.write(self.contents)
+        self.contents = None
+
+    def write_data(self):
+        """Write the contents as a data command."""
+        if not self.spilled:
+            out('data {}\n'.format(len(self.contents)))
+            bytes_out(self.contents)
+            out('\n')
+            return
+
+        out('data {}\n'.format(self.spilled.tell()))
+        self.spilled.seek(0)
+        while True:
+            chunk = self.spilled.read(1 << 20)
+            if not chunk:
+                break
+            bytes_out(chunk)
         out('\n')
+        self.spilled.close()
+        self.spilled = None
+
+    def write_blob(self):
+        if self.meta['options'].SINGLE_PASS:
+            self.write_commit()
+            return
+
+        # No mark, write_meta stored the object id for the commit step.
+        with OUTPUT_LOCK:
+            out('blob\n')
+            self.write_data()
+
+    def write_commit(self):
+        info = {
+            'rev':    self.id,
+            'epoch':  timegm(self.timestamp.utctimetuple()),
+            'page':   self.page,
+            'user':   str(ipaddress.ip_address(self.user.id)) if self.user.isip else self.user.id,
+            'minor':  self.minor,
+            'isip':   self.user.isip,
+            'isdel':  self.user.isdel,
+            'upload': self.upload,
+            }
+        filename = create_path(self.title[0], self.title[1], self.upload, self.meta)
+
+        with OUTPUT_LOCK:
+            out(commit_command(self.meta, info, self.user.name,
+                self.comment or '', filename, 'inline'))
+            self.write_data()
 
 
 class Page:
@@ -344,14 +704,17 @@ class Page:
         self.saveTitle()
 
     def saveTitle(self):
+        if self.meta['options'].SINGLE_PASS:
+            return
+
         if self.id != -1 and self.title != '':
             self.meta['page'].write(self.id, self.title, self.nsid)
 
     def addRevision(self, node):
-        Revision(node, self.id, self.meta)
+        return Revision(node, self.id, self.meta, title=(self.nsid, self.title))
 
     def addUpload(self, node):
-        Revision(node, self.id, self.meta, upload=True)
+        return Revision(node, self.id, self.meta, upload=True, title=(self.nsid, self.title))
 
 
 class XMLError(ValueError):
@@ -362,6 +725,197 @@ class CancelException(Exception):
     pass
 
 
+class SerialSink:
+    """Sink that writes each revision right away, on the calling thread."""
+
+    def put(self, revision):
+        revision.write_meta()
+        revision.write_blob()
+
+    def close(self):
+        pass
+
+
+class Stage(threading.Thread):
+    """One stage of a Pipeline: a thread working off a bounded queue.
+
+    Attributes:
+      work: callable, called with each item taken from the queue.
+      following: Stage to pass each item on to after work is done, or None.
+      error: exception that ended this stage, or None.
+      items: int, number of items worked on.
+      waited: float, seconds spent waiting for items to arrive.
+      stalled: float, seconds spent waiting for the following stage to accept
+          items. The last stage has none, its work is writing the output, so
+          for it this is the time spent in work.
+      depth_sum, depth_max: int, sum and maximum of the queue depth, sampled
+          whenever an item is taken from the queue.
+    """
+
+    def __init__(self, name, work, size, pipeline, following=None):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue(size)
+        self.work = work
+        self.pipeline = pipeline
+        self.following = following
+        self.error = None
+        self.items = self.depth_sum = self.depth_max = 0
+        self.waited = self.stalled = 0.0
+
+    def run(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.waited += time.perf_counter() - start
+                if item is None:
+                    break
+
+                depth = self.queue.qsize()
+                self.depth_sum += depth
+                self.depth_max = max(self.depth_max, depth)
+                self.items += 1
+
+                if self.following:
+                    self.work(item)
+                    self.stalled += self.pipeline.offer(self.following, item)
+                else:
+                    start = time.perf_counter()
+                    self.work(item)
+                    self.stalled += time.perf_counter() - start
+        except BaseException as e:
+            self.error = e
+            self.pipeline.failed.set()
+        finally:
+            if self.following:
+                self.pipeline.finish(self.following)
+
+
+class Pipeline:
+    """Sink that writes revisions on a chain of threads.
+
+    The thread feeding the pipeline (the parser) only parses. One stage writes
+    the metadata stores, the next one writes the blobs to stdout. The queues
+    between them are bounded, so a stalled stage makes the earlier ones wait
+    instead of piling up revisions in memory. Expat, lxml, file and pipe I/O
+    release the GIL, so the stages overlap.
+
+    Under memory pressure the governor halves the queues and lowers the size
+    above which revisions waiting for the output stage are spilled to
+    temporary files.
+
+    Attributes:
+      stages: list of Stage, in pipeline order.
+      failed: threading.Event, set as soon as a stage ended with an exception.
+      stalled: float, seconds the parser spent waiting for the first stage.
+      governor: MemoryGovernor the queues are registered with.
+      spill_threshold: int, revisions bigger than this many bytes are spilled
+          after their metadata is written, or None to spill nothing.
+      spilled: int, number of revisions spilled.
+    """
+
+    # Spill threshold after the first shrink, and the lowest one, in bytes.
+    FIRST_SPILL = 4 << 20
+    MIN_SPILL = 64 << 10
+
+    def __init__(self, size, governor):
+        self.failed = threading.Event()
+        self.stalled = 0.0
+        self.governor = governor
+        self.spill_threshold = None
+        self.spilled = 0
+        output = Stage('output', lambda r: r.write_blob(), size, self)
+        metadata = Stage('metadata', self.write_meta, size, self, output)
+        self.stages = [metadata, output]
+        for stage in self.stages:
+            stage.start()
+        self.governor.register('pipeline queues', self.size, self.shrink)
+
+    def write_meta(self, revision):
+        revision.write_meta()
+        if self.spill_threshold is not None and revision.size() > self.spill_threshold:
+            revision.spill()
+            self.spilled += 1
+
+    def size(self):
+        """Return the bytes of revision contents waiting in the queues."""
+        size = 0
+        for stage in self.stages:
+            with stage.queue.mutex:
+                size += sum(r.size() for r in stage.queue.queue if r)
+        return size
+
+    def shrink(self):
+        """Halve the queues and the spill threshold, return the bytes freed.
+
+        Nothing is freed right away, the queues drain as the stages go on.
+        """
+        if self.spill_threshold == self.MIN_SPILL:
+            return 0
+        before = self.size()
+        for stage in self.stages:
+            with stage.queue.mutex:
+                stage.queue.maxsize = max(stage.queue.maxsize // 2, 1)
+        if self.spill_threshold is None:
+            self.spill_threshold = self.FIRST_SPILL
+        else:
+            self.spill_threshold = max(self.spill_threshold // 2, self.MIN_SPILL)
+        return before // 2
+
+    def offer(self, stage, item):
+        """Put an item into the queue of a stage, return the seconds it took.
+
+        Raises CancelException if any stage failed in the meantime, as the item
+        might never be taken from the queue then.
+        """
+        start = time.perf_counter()
+        while True:
+            if self.failed.is_set():
+                raise CancelException()
+            try:
+                stage.queue.put(item, timeout=0.1)
+                return time.perf_counter() - start
+            except queue.Full:
+                pass
+
+    def finish(self, stage):
+        """Tell a stage that no more items will follow."""
+        while stage.is_alive():
+            try:
+                stage.queue.put(None, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def put(self, revision):
+        self.stalled += self.offer(self.stages[0], revision)
+        self.governor.tick()
+
+    def close(self):
+        """Wait for all stages to finish, then report on them.
+
+        Raises the exception of the failed stage, if any.
+        """
+        self.finish(self.stages[0])
+        for stage in self.stages:
+            stage.join()
+        self.governor.unregister('pipeline queues')
+
+        # Stages cancelled because a later stage failed are of no interest.
+        for stage in self.stages:
+            if stage.error and not isinstance(stage.error, CancelException):
+                raise stage.error
+
+        progress('pipeline: parser stalled %.1fs on the metadata stage' % self.stalled)
+        if self.spilled:
+            progress('pipeline: spilled %d revisions bigger than %d KiB to disk' % (
+                self.spilled, self.spill_threshold >> 10))
+        for stage in self.stages:
+            progress('pipeline: %s stage: %d items, queue depth avg %.1f max %d, waited %.1fs for input, stalled %.1fs on output' % (
+                stage.name, stage.items, stage.depth_sum / max(stage.items, 1),
+                stage.depth_max, stage.waited, stage.stalled))
+
+
 class ParserHandler:
     def __init__(self, writer):
         self.writer = writer
@@ -562,13 +1116,23 @@ class BlobWriter:
           namespace to id mapping.
       page: Current page being processed.
       parser: xml parser that this object is driven by.
+      planner: Planner deciding which pages to sample, or None to import all.
+      sink: SerialSink, Pipeline or Planner, writing out the parsed revisions.
     """
 
-    def __init__(self, meta):
+    def __init__(self, meta, planner=None):
         self.imported = 0
         self.canceled = False
         self.meta = meta
         self.parser = self.page = None
+        self.planner = planner
+
+        if self.planner:
+            self.sink = self.planner
+        elif self.meta['options'].PIPELINE:
+            self.sink = Pipeline(self.meta['options'].QUEUE_SIZE, self.meta['governor'])
+        else:
+            self.sink = SerialSink()
 
     def parse(self, parser):
         self.parser = parser(StackManager((self.start_root, None, None)))
@@ -577,6 +1141,8 @@ class BlobWriter:
         except CancelException:
             if not self.canceled:
                 raise
+        finally:
+            self.sink.close()
 
     def start_root(self, tag, attrs):
         if tag[0] != XMLNS:
@@ -618,6 +1184,12 @@ class BlobWriter:
         if self.page:
             raise XMLError("Page capture requested while already in progress.")
         self.page = Page(self.meta)
+        if self.planner and not self.planner.start_page():
+            return (
+                Cases(id=Capture(self.planner.process_skipped_page_id)),
+                self.end_page,
+                None,
+            )
         return (
             Cases(
                 title=Capture(self.process_captured_title),
@@ -634,6 +1206,8 @@ class BlobWriter:
             raise XMLError("Page termination requested while not in progress.")
         self.page = None
         self.imported += 1
+        if self.planner:
+            self.planner.end_page()
         max = self.meta['options'].IMPORT_MAX
         if max > 0 and self.imported >= max:
             self.canceled = True
@@ -647,10 +1221,888 @@ class BlobWriter:
         self.page.setID(int(singletext(node)))
 
     def process_captured_revision(self, node):
-        self.page.addRevision(node)
+        self.sink.put(self.page.addRevision(node))
 
     def process_captured_upload(self, node):
-        self.page.addUpload(node)
+        self.sink.put(self.page.addUpload(node))
+
+
+def commit_markfile(options):
+    """Return the marks file the commit step exports its marks to.
+
+    An export of selected pages gets one of its own, named after its branch,
+    so its commit marks don't overwrite those of the full import.
+    """
+    if not (options.PAGE_IDS or options.PAGE_TITLES or options.NAMESPACES):
+        return options.MARKFILE
+    return '%s-%s' % (options.MARKFILE, re.sub(r'[^\w.]+', '-', options.BRANCH))
+
+
+class FastImportError(Exception):
+    pass
+
+
+class TimedPipe(io.RawIOBase):
+    """Raw writer for a pipe that keeps track of how long writes block.
+
+    Attributes:
+      fd: int, the file descriptor to write to.
+      blocked: float, seconds spent in write calls.
+      written: int, number of bytes written.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.blocked = 0.0
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        start = time.perf_counter()
+        n = os.write(self.fd, data)
+        self.blocked += time.perf_counter() - start
+        self.written += n
+        return n
+
+
+class FastImport:
+    """Runs git fast-import and makes it the destination of all output.
+
+    In the commit step, the marks file is imported if it exists and exported
+    when fast-import is done. Other steps need no marks. fast-import's
+    stdout, where it echoes our progress lines, is shared with ours. Its
+    stderr is collected, to report its statistics at the end and its error
+    messages if it fails.
+
+    Attributes:
+      proc: subprocess.Popen, the fast-import process.
+      pipe: TimedPipe, the write end of its stdin.
+      stderr: list of str, lines fast-import wrote to stderr.
+      started: float, time.time() when fast-import was started.
+    """
+
+    def __init__(self, options):
+        global OUTPUT
+
+        args = [
+            'git', 'fast-import', '--stats',
+            '--depth=%d' % options.PACK_DEPTH,
+            '--max-pack-size=%s' % options.MAX_PACK_SIZE,
+            ]
+        # Blobs are referenced by object id, only commits use marks. An
+        # export of selected pages only has the marks of its own commits, in
+        # a file of its own, unless --blob-marks asks for the full import's
+        # marks for blobs from before object ids were stored.
+        if not (options.SINGLE_PASS or options.ONLYBLOB):
+            markfile = commit_markfile(options)
+            if markfile == options.MARKFILE or options.BLOB_MARKS:
+                args.append('--import-marks-if-exists=%s' % os.path.abspath(options.MARKFILE))
+            if markfile != options.MARKFILE:
+                args.append('--import-marks-if-exists=%s' % os.path.abspath(markfile))
+            args.append('--export-marks=%s' % os.path.abspath(markfile))
+        env = dict(os.environ, GIT_DIR=options.GIT_DIR)
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=env)
+        self.started = time.time()
+
+        fd = self.proc.stdin.fileno()
+        size = self.set_pipe_size(fd, options.PIPE_SIZE)
+        self.pipe = TimedPipe(fd)
+        OUTPUT = io.BufferedWriter(self.pipe, buffer_size=size)
+
+        self.stderr = []
+        self.reader = threading.Thread(target=self.read_stderr, daemon=True)
+        self.reader.start()
+
+    def set_pipe_size(self, fd, size):
+        """Try to grow the pipe buffer to size bytes, return the size we got."""
+        try:
+            import fcntl
+            # F_SETPIPE_SZ is Linux only, and only exported by Python 3.10+.
+            return fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+        except (ImportError, OSError) as e:
+            progress('warning: could not set the pipe size to %d bytes: %s' % (size, e))
+            return io.DEFAULT_BUFFER_SIZE
+
+    def read_stderr(self):
+        for line in io.TextIOWrapper(self.proc.stderr, encoding=ENCODING, errors='replace'):
+            self.stderr.append(line.rstrip('\n'))
+
+    def stats(self):
+        """Return the statistics fast-import printed, as a dict.
+
+        fast-import prints lines like 'blobs  :  139 (  0 duplicates ...)'.
+        The key is the part before the colon, the value the list of numbers
+        after it.
+        """
+        stats = {}
+        for line in self.stderr:
+            match = re.match(r'\s*([^:]+?)\s*:\s*(\d.*)', line)
+            if match:
+                stats.setdefault(match.group(1),
+                        [int(n) for n in re.findall(r'\d+', match.group(2))])
+        return stats
+
+    def close(self):
+        """Finish the stream, wait for fast-import and report on the run.
+
+        Raises FastImportError if fast-import did not succeed.
+        """
+        global OUTPUT
+
+        try:
+            # Closing the buffer only flushes it, the pipe itself belongs to
+            # proc.stdin.
+            OUTPUT.close()
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            # fast-import is gone, its exit status will tell why.
+            pass
+        OUTPUT = None
+        self.proc.wait()
+        self.reader.join()
+
+        if self.proc.returncode != 0:
+            # The statistics come last, the messages that matter before them.
+            messages = self.stderr
+            for i, line in enumerate(messages):
+                if line.endswith('fast-import statistics:'):
+                    messages = messages[:i]
+                    break
+            raise FastImportError('git fast-import exited with status %d:\n%s' % (
+                self.proc.returncode, '\n'.join(messages[-20:])))
+
+        elapsed = max(time.time() - self.started, 1e-9)
+        stats = self.stats()
+        progress('fast-import: %d blobs, %d commits, %d unique marks, %d KiB memory' % (
+            stats.get('blobs', [0])[0], stats.get('commits', [0])[0],
+            stats.get('marks', [0, 0])[-1], stats.get('Memory total', [0])[0]))
+        progress('fast-import: wrote %d MiB in %.1fs, writes blocked for %.1fs (%.0f%%)' % (
+            self.pipe.written >> 20, elapsed, self.pipe.blocked,
+            100 * self.pipe.blocked / elapsed))
+
+
+class PreScanner:
+    """Object to scan Mediawiki XML for ids and sizes, without parsing it.
+
+    This relies on the layout of MediaWiki dumps, which put each tag outside
+    of the revision texts on a line of its own. Lines without a '<' can only
+    be text contents, since a '<' in a text is escaped, so most lines are
+    skipped right away.
+
+    Attributes:
+      maxpage, maxrev, maxuser: int, the highest page, revision and user id.
+      uploads: int, number of uploads.
+      namespaces: dict, mapping namespace ids to dicts with the number of
+          'pages' and 'revisions' and the 'bytes' of revision text.
+      nsnames: dict, mapping namespace ids to names, from the siteinfo.
+    """
+
+    def __init__(self):
+        self.maxpage = self.maxrev = self.maxuser = self.uploads = 0
+        self.namespaces = {}
+        self.nsnames = {}
+
+    def scan(self, stream):
+        ns = None
+        where = []
+        textlen = None
+
+        for line in stream:
+            if textlen is not None:
+                # A text without a bytes attribute, measure it.
+                end = line.find(b'</text>')
+                if end == -1:
+                    textlen += len(line)
+                    continue
+                ns['bytes'] += textlen + end
+                textlen = None
+                continue
+
+            if b'<' not in line:
+                continue
+            line = line.strip()
+
+            if line.startswith(b'<id>'):
+                id = int(line[4:line.index(b'<', 4)])
+                if where[-1] == b'contributor':
+                    self.maxuser = max(self.maxuser, id)
+                elif where[-1] == b'revision':
+                    self.maxrev = max(self.maxrev, id)
+                elif where[-1] == b'page':
+                    self.maxpage = max(self.maxpage, id)
+            elif line.startswith(b'<namespace '):
+                key = int(re.search(rb'key="(-?\d+)"', line).group(1))
+                name = re.search(rb'>(.*)</namespace>', line)
+                self.nsnames[key] = name.group(1).decode(ENCODING) if name else ''
+            elif line.startswith(b'<ns>'):
+                ns = self.namespaces.setdefault(int(line[4:line.index(b'<', 4)]),
+                        {'pages': 0, 'revisions': 0, 'bytes': 0})
+                ns['pages'] += 1
+            elif line.startswith(b'<text'):
+                match = re.search(rb'bytes="(\d+)"', line)
+                if match:
+                    ns['bytes'] += int(match.group(1))
+                elif not line.endswith(b'/>'):
+                    start = line.index(b'>') + 1
+                    end = line.find(b'</text>', start)
+                    if end == -1:
+                        textlen = len(line) - start + 1
+                    else:
+                        ns['bytes'] += end - start
+            elif line in (b'<page>', b'<revision>', b'<upload>', b'<contributor>'):
+                where.append(line[1:-1])
+                if line == b'<revision>':
+                    ns['revisions'] += 1
+                elif line == b'<upload>':
+                    self.uploads += 1
+            elif line in (b'</page>', b'</revision>', b'</upload>', b'</contributor>'):
+                where.pop()
+            elif line.startswith(b'<contributor') and line.endswith(b'/>'):
+                # <contributor deleted="deleted" />, no ids inside.
+                pass
+            elif line.startswith(b'<contributor'):
+                where.append(b'contributor')
+
+    def report(self):
+        def mib(n):
+            return '%.1f MiB' % (n / 2**20)
+
+        print('Max page id:     %d' % self.maxpage)
+        print('Max revision id: %d' % self.maxrev)
+        print('Max user id:     %d' % self.maxuser)
+        print('Uploads:         %d' % self.uploads)
+        print('Namespace                     Pages   Revisions        Text')
+        for key in sorted(self.namespaces):
+            ns = self.namespaces[key]
+            print('%-4d %-20s %10d %11d %11s' % (key, self.nsnames.get(key, '')[:20],
+                ns['pages'], ns['revisions'], mib(ns['bytes'])))
+        print('Total                     %10d %11d %11s' % (
+            sum(ns['pages'] for ns in self.namespaces.values()),
+            sum(ns['revisions'] for ns in self.namespaces.values()),
+            mib(sum(ns['bytes'] for ns in self.namespaces.values()))))
+
+    def preallocate(self, meta):
+        """Allocate the stores for all ids seen, in contiguous extents.
+
+        Stores are only ever grown, so scanning the parts of a multi-part dump
+        one after another works. Preallocated records read as missing.
+        """
+        maxupload = meta['max_upload'] + self.uploads
+        sizes = [
+            ('meta', self.maxrev),
+            ('comm', self.maxrev),
+            ('uplo', maxupload),
+            ('upco', maxupload),
+            ('user', self.maxuser),
+            ('page', self.maxpage),
+            ('hash', self.maxrev),
+            ('uphs', maxupload),
+            ]
+        for key, maxid in sizes:
+            store = meta[key]
+            size = (maxid + 1) * store.struct.size
+            store.fh.seek(0, os.SEEK_END)
+            if store.fh.tell() < size:
+                try:
+                    os.posix_fallocate(store.fh.fileno(), 0, size)
+                except OSError as e:
+                    print('warning: could not preallocate %s: %s' % (key, e))
+                    continue
+            print('Allocated %s: %.1f MiB' % (key, size / 2**20))
+
+
+class CountingOutput:
+    """Output that throws everything away, counting the bytes."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def flush(self):
+        pass
+
+
+class Planner:
+    """Estimates the resources of an import from a sample of its pages.
+
+    The sampled pages go through the real blob step, into information files in
+    a temporary directory, and then through the real commit step. Output is
+    counted, not written. The other pages are skipped after reading their id.
+    Everything measured is then scaled up by the number of pages seen over the
+    number of pages sampled.
+
+    Attributes:
+      fraction: float, the fraction of pages to sample.
+      pages, sampled: int, number of pages seen and sampled.
+      maxpage, maxrev, maxuser: int, the highest ids seen. Page ids are seen
+          for all pages, revision and user ids only for sampled ones.
+      revisions, uploads: int, number of sampled revisions and uploads.
+      content, compressed: int, bytes of sampled content, plain and deflated.
+      blob_time, commit_time: float, seconds spent on the sampled pages in
+          the blob step and on their commits in the commit step.
+    """
+
+    # Rough size of an object entry in git fast-import, including its share
+    # of the object table.
+    FAST_IMPORT_OBJECT_SIZE = 100
+
+    # Option names of the files that get replaced by temporary ones.
+    FILE_OPTIONS = ['PKLFILE', 'METAFILE', 'COMMFILE', 'UPLOFILE', 'UPCOFILE',
+        'USERFILE', 'PAGEFILE', 'HASHFILE', 'UPHASHFILE', 'IDXFILE',
+        'UPIDXFILE', 'CKPTFILE', 'MARKFILE']
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.fraction = meta['options'].PLAN_FRACTION
+        self.pages = self.sampled = 0
+        self.maxpage = self.maxrev = self.maxuser = 0
+        self.revisions = self.uploads = self.content = self.compressed = 0
+        self.blob_time = self.commit_time = 0.0
+        self.page_started = None
+        self.info = None
+
+    def start_page(self):
+        """Decide whether to sample the page just started.
+
+        Pages are picked evenly, whenever the number of pages times the
+        fraction reaches the next integer.
+        """
+        self.pages += 1
+        if int(self.pages * self.fraction) == int((self.pages - 1) * self.fraction):
+            return False
+
+        self.sampled += 1
+        self.page_started = time.perf_counter()
+        return True
+
+    def end_page(self):
+        if self.page_started is not None:
+            self.blob_time += time.perf_counter() - self.page_started
+            self.page_started = None
+
+    def process_skipped_page_id(self, node):
+        self.maxpage = max(self.maxpage, int(singletext(node)))
+
+    def put(self, revision):
+        """Sink for the sampled revisions, see BlobWriter."""
+        if revision.upload:
+            self.uploads += 1
+        else:
+            self.revisions += 1
+            self.maxrev = max(self.maxrev, revision.id)
+        if not (revision.user.isip or revision.user.isdel):
+            self.maxuser = max(self.maxuser, revision.user.id)
+        self.maxpage = max(self.maxpage, revision.page)
+        self.content += len(revision.contents)
+        self.compressed += len(zlib.compress(revision.contents, 1))
+
+        revision.write_meta()
+        revision.write_blob()
+
+    def close(self):
+        pass
+
+    def run(self, parser):
+        global OUTPUT
+
+        options = copy.copy(self.meta['options'])
+        options.RESUME = options.PIPELINE = options.SINGLE_PASS = False
+
+        with tempfile.TemporaryDirectory(prefix='levitation-plan-') as tmp:
+            for name in self.FILE_OPTIONS:
+                setattr(options, name, os.path.join(tmp, name.lower()))
+            meta = dict(self.meta, options=options)
+            stores = open_stores(options)
+            meta.update(stores)
+
+            OUTPUT = self.output = CountingOutput()
+            try:
+                BlobWriter(meta, planner=self).parse(parser)
+                self.blob_output = self.output.written
+
+                # Reopen, so --jobs workers see everything written.
+                for store in stores.values():
+                    store.close()
+                stores = open_stores(options)
+                meta.update(stores)
+
+                start = time.perf_counter()
+                Committer(meta).work()
+                self.commit_time = time.perf_counter() - start
+                self.commit_output = self.output.written - self.blob_output
+
+                # A typical entry of the --sort list.
+                for index in range(self.maxrev + 1):
+                    self.info = meta['meta'].read(index)
+                    if self.info and self.info['exists']:
+                        break
+            finally:
+                OUTPUT = None
+                for store in stores.values():
+                    store.close()
+
+        self.report(meta)
+
+    def report(self, meta):
+        def size(n):
+            for unit in ('bytes', 'KiB', 'MiB', 'GiB', 'TiB'):
+                if n < 1024 or unit == 'TiB':
+                    return '%.1f %s' % (n, unit)
+                n /= 1024
+
+        def duration(seconds):
+            return '%dh %02dm %02ds' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+        if not self.sampled:
+            print('No pages sampled, nothing to plan.')
+            return
+
+        scale = self.pages / self.sampled
+        revisions = int(self.revisions * scale)
+        uploads = int(self.uploads * scale)
+        commits = revisions + uploads
+
+        print('Sampled %d of %d pages with %d revisions and %d uploads, scaling by %.1f.' % (
+            self.sampled, self.pages, self.revisions, self.uploads, scale))
+        print('Estimated: %d revisions, %d uploads, max ids: page %d, rev %d, user %d.' % (
+            revisions, uploads, self.maxpage, self.maxrev, self.maxuser))
+        print('')
+
+        print('Information files:')
+        files = [
+            ('revision metadata', meta['meta'], self.maxrev),
+            ('revision comments', meta['comm'], self.maxrev),
+            ('revision object ids', meta['hash'], self.maxrev),
+            ('upload metadata', meta['uplo'], uploads),
+            ('upload comments', meta['upco'], uploads),
+            ('upload object ids', meta['uphs'], uploads),
+            ('author names', meta['user'], self.maxuser),
+            ('page titles', meta['page'], self.maxpage),
+            ]
+        total = 0
+        for name, store, maxid in files:
+            total += (maxid + 1) * store.struct.size
+            print('  %-24s %12s' % (name, size((maxid + 1) * store.struct.size)))
+        index = (self.maxpage + self.maxrev + 2) * meta['pidx'].struct.size
+        print('  %-24s %12s' % ('total', size(total)))
+        print('  %-24s %12s (only for exporting subsets)' % ('page index', size(index)))
+        print('')
+
+        print('Repository:')
+        print('  %-24s %12s' % ('blob contents', size(self.content * scale)))
+        print('  %-24s %12s (upper bound, git deltas do better)' % ('deflated blobs', size(self.compressed * scale)))
+        # Lines of ':mark sha\n', for commits only.
+        print('  %-24s %12s' % ('marks file',
+            size(commits * (len(':%d ' % commit_mark(commits)) + 41))))
+        print('')
+
+        print('Memory:')
+        if self.info:
+            entry = sys.getsizeof(self.info) + sum(sys.getsizeof(v) for v in self.info.values()) + 8
+            print('  %-24s %12s' % ('--sort', size(commits * entry)))
+        print('  %-24s %12s (rough)' % ('fast-import, blob step',
+            size(revisions * self.FAST_IMPORT_OBJECT_SIZE)))
+        # A commit adds a commit object and a tree for each directory level.
+        objects = commits * (3 + meta['options'].DEEPNESS)
+        print('  %-24s %12s (rough)' % ('fast-import, commit step',
+            size(objects * self.FAST_IMPORT_OBJECT_SIZE)))
+        print('')
+
+        print('Time spent in levitation (git fast-import comes on top):')
+        print('  %-24s %12s (writing %s)' % ('blob step', duration(self.blob_time * scale),
+            size(self.blob_output * scale)))
+        print('  %-24s %12s (writing %s)' % ('commit step', duration(self.commit_time * scale),
+            size(self.commit_output * scale)))
+
+
+class Verifier:
+    """Checks an imported repository against the information files.
+
+    The blobs of all present revisions and uploads, or those of the pages
+    selected with --page-id, --page-title and --namespace, are checked in one
+    go by a single git cat-file --batch-check. A feeder thread writes their
+    object ids while the main thread reads the answers, so neither waits for
+    the other. Then the history of the branch is walked once to count its
+    commits, and the tree at its tip is checked for the path of every page.
+    git failing, like for a wrong --git-dir or branch, is a problem too.
+
+    Attributes:
+      problems: collections.Counter, number of problems found by kind.
+      examples: list of str, the first few problems of each kind.
+      checked: int, number of revisions and uploads checked.
+    """
+
+    EXAMPLES = 10
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.env = dict(os.environ)
+        if meta['options'].GIT_DIR:
+            self.env['GIT_DIR'] = meta['options'].GIT_DIR
+        self.problems = collections.Counter()
+        self.examples = []
+        self.checked = 0
+        self.marks = None
+
+    def problem(self, kind, what):
+        self.problems[kind] += 1
+        if self.problems[kind] <= self.EXAMPLES:
+            self.examples.append('%s: %s' % (kind, what))
+
+    def blob_problem(self, kind, info):
+        self.problem(kind, '%s %d of page %d' % (
+            'upload' if info['upload'] else 'rev', info['rev'], info['page']))
+
+    def git(self, *args):
+        return subprocess.run(('git',) + args, stdout=subprocess.PIPE,
+                env=self.env, check=True).stdout
+
+    def blob(self, info):
+        """Return (object id, size) of the blob of a revision or upload.
+
+        Blobs from before object ids were stored are looked up in the marks
+        file, their size is None then. Returns (None, None) if the blob is
+        not known at all.
+        """
+        if info['upload']:
+            blob = self.meta['uphs'].read(info['rev'])
+            mark = upload_mark(info['rev'])
+        else:
+            blob = self.meta['hash'].read(info['rev'])
+            mark = revision_mark(info['rev'])
+
+        if blob:
+            return blob['sha'], blob['size']
+
+        if self.marks is None:
+            self.marks = {}
+            try:
+                with open(self.meta['options'].MARKFILE, 'rb') as f:
+                    for line in f:
+                        num, sha = line.split()
+                        self.marks[int(num[1:])] = sha.decode(ENCODING)
+            except FileNotFoundError:
+                pass
+
+        return self.marks.get(mark), None
+
+    def infos(self):
+        """Return the information of the revisions and uploads to check."""
+        committer = Committer(self.meta)
+        pages = committer.selected_pages()
+        if pages is None:
+            return committer.all_infos()
+        print('Checking %d selected pages.' % len(pages))
+        return committer.selected_infos(pages)
+
+    def feed(self, infos, stdin, pending):
+        """Write the object ids of all blobs, queue what to expect back."""
+        try:
+            for info in infos:
+                sha, size = self.blob(info)
+                if sha:
+                    stdin.write(bytes(sha + '\n', ENCODING))
+                try:
+                    pending.put_nowait((info, sha, size))
+                except queue.Full:
+                    # The answers we are about to wait for must not be stuck
+                    # in our buffer.
+                    stdin.flush()
+                    pending.put((info, sha, size))
+        except BrokenPipeError:
+            # git cat-file is gone, check_blobs reports that.
+            pass
+        finally:
+            pending.put(None)
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def check_blobs(self):
+        """Check all blobs, return a bytearray of the pages to check.
+
+        Entry 2*page is set if the page has revisions, 2*page+1 if it has
+        uploads.
+        """
+        pages = bytearray(2 * self.meta['page'].count())
+        infos = self.infos()
+        proc = subprocess.Popen(['git', 'cat-file', '--batch-check'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env)
+        pending = queue.Queue(100000)
+        feeder = threading.Thread(target=self.feed, args=(infos, proc.stdin, pending), daemon=True)
+        feeder.start()
+
+        gone = False
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if gone:
+                # Let the feeder finish.
+                continue
+
+            info, sha, size = item
+            self.checked += 1
+            if 2 * info['page'] + 1 < len(pages):
+                pages[2 * info['page'] + info['upload']] = 1
+
+            if not sha:
+                self.blob_problem('no object id', info)
+                continue
+
+            # '<sha> blob <size>' or '<sha> missing'
+            answer = proc.stdout.readline().split()
+            if not answer:
+                gone = True
+                continue
+            if answer[1] == b'missing':
+                self.blob_problem('missing blob', info)
+            elif answer[1] != b'blob':
+                self.blob_problem('not a blob', info)
+            elif size is not None and int(answer[2]) != size:
+                self.blob_problem('wrong size', info)
+
+            if self.checked % 1000000 == 0:
+                print('Checked %d blobs.' % self.checked)
+
+        feeder.join()
+        status = proc.wait()
+        if gone or status:
+            self.problem('git failed', 'git cat-file exited with status %d' % status)
+        return pages
+
+    def check_branch(self, pages):
+        branch = self.meta['options'].BRANCH
+        try:
+            commits = int(self.git('rev-list', '--count', branch))
+            paths = set(self.git('ls-tree', '-r', '--name-only', '-z', branch).split(b'\0'))
+        except subprocess.CalledProcessError as e:
+            self.problem('git failed', 'git %s %s exited with status %d' % (
+                e.cmd[1], branch, e.returncode))
+            return
+
+        if commits != self.checked:
+            self.problem('commit count', '%s has %d commits, expected %d' % (
+                branch, commits, self.checked))
+        for index in range(len(pages)):
+            if not pages[index]:
+                continue
+            page, upload = divmod(index, 2)
+            title = self.meta['page'].read(page)
+            path = create_path(title['flags'], title['text'], bool(upload), self.meta)
+            if bytes(path, ENCODING) not in paths:
+                self.problem('missing path', 'page %d at %s' % (page, path))
+
+    def run(self):
+        """Run all checks and print a report. Returns True if all is well."""
+        start = time.time()
+        pages = self.check_blobs()
+        elapsed = max(time.time() - start, 1e-9)
+        print('Checked %d blobs in %.1fs (%d per minute).' % (
+            self.checked, elapsed, self.checked * 60 / elapsed))
+
+        self.check_branch(pages)
+
+        for example in self.examples:
+            print(example)
+        for kind in sorted(self.problems):
+            print('%d x %s' % (self.problems[kind], kind))
+        if not self.problems:
+            print('No problems found.')
+
+        return not self.problems
+
+
+class BatchError(Exception):
+    pass
+
+
+class Batch:
+    """Imports the wikis listed in a manifest, several at a time.
+
+    The manifest is a JSON list with an object per wiki:
+
+      name: string, used in reports (default: the name of repo).
+      dumps: list of dump files, in order, plain or compressed with 7z, bzip2,
+          gzip or xz.
+      repo: the bare repository to import into, created if missing.
+      storedir: directory for the information files and the log of this
+          wiki, created if missing.
+      options: list of further levitation options, for all steps.
+
+    Relative paths are relative to the manifest. Every step runs levitation
+    with --git-dir in the storedir of its wiki, so each wiki has its own
+    information files. A pool of --workers threads takes the wikis biggest
+    first, so the long imports start early and small ones fill in the gaps at
+    the end. Each wiki goes through the blob step of each dump, then the
+    commit step. Finished steps are noted in import-prog in the storedir and
+    skipped when the batch is run again.
+
+    Attributes:
+      wikis: list of dicts, the manifest entries, biggest first.
+      failed: list of (name, error) of the wikis that failed.
+      imported: int, bytes of dumps imported by this run.
+    """
+
+    LEVITATION = os.path.abspath(__file__)
+    DECOMPRESSORS = {
+        '.7z':  ['7z', 'x', '-so'],
+        '.bz2': ['bzip2', '-dc'],
+        '.gz':  ['gzip', '-dc'],
+        '.xz':  ['xz', '-dc'],
+        }
+
+    def __init__(self, options):
+        self.options = options
+        with open(options.BATCH) as f:
+            manifest = json.load(f)
+
+        self.failed = []
+        self.imported = 0
+        self.lock = threading.Lock()
+
+        # A broken entry only fails its own wiki.
+        base = os.path.dirname(os.path.abspath(options.BATCH))
+        self.wikis = []
+        for number, entry in enumerate(manifest, 1):
+            name = 'entry %d' % number
+            try:
+                if not isinstance(entry, dict):
+                    raise BatchError('not an object')
+                name = entry.get('name', name)
+                self.wikis.append(self.wiki(entry, base))
+            except (BatchError, OSError) as e:
+                self.failed.append((name, e))
+                self.report('%s: %s' % (name, e))
+        self.wikis.sort(key=lambda w: w['bytes'], reverse=True)
+
+    def wiki(self, entry, base):
+        """Return the dict of a wiki from its manifest entry.
+
+        Raises BatchError or OSError if the entry is incomplete or a dump is
+        missing.
+        """
+        for key in ('dumps', 'repo', 'storedir'):
+            if key not in entry:
+                raise BatchError('no %s given' % key)
+        dumps = entry['dumps']
+        if isinstance(dumps, str):
+            dumps = [dumps]
+        wiki = {
+            'repo':     os.path.join(base, entry['repo']),
+            'storedir': os.path.join(base, entry['storedir']),
+            'dumps':    [os.path.join(base, d) for d in dumps],
+            'options':  list(entry.get('options', [])),
+            }
+        wiki['name'] = entry.get('name', os.path.basename(wiki['repo'].rstrip('/')))
+        wiki['bytes'] = sum(os.path.getsize(d) for d in wiki['dumps'])
+        return wiki
+
+    def report(self, text):
+        with self.lock:
+            print(text)
+            sys.stdout.flush()
+
+    def step(self, wiki, args, dump=None):
+        """Run levitation for one step of a wiki, raise BatchError on failure."""
+        log = os.path.join(wiki['storedir'], 'import-log')
+        command = [sys.executable, self.LEVITATION, '-m', '-1',
+                   '--git-dir', wiki['repo']] + wiki['options'] + args
+        with open(log, 'ab') as logf:
+            logf.write(bytes('$ %s\n' % ' '.join(command), ENCODING))
+            logf.flush()
+
+            decompress = None
+            stdin = subprocess.DEVNULL
+            if dump:
+                decompressor = self.DECOMPRESSORS.get(os.path.splitext(dump)[1])
+                if decompressor:
+                    decompress = subprocess.Popen(decompressor + [dump],
+                            stdout=subprocess.PIPE, stderr=logf)
+                    stdin = decompress.stdout
+                else:
+                    stdin = open(dump, 'rb')
+
+            try:
+                proc = subprocess.Popen(command, stdin=stdin, stdout=logf,
+                        stderr=subprocess.STDOUT, cwd=wiki['storedir'])
+            finally:
+                if stdin is not subprocess.DEVNULL:
+                    stdin.close()
+            status = proc.wait()
+            if decompress and decompress.wait():
+                raise BatchError('%s failed on %s, see %s' % (decompress.args[0], dump, log))
+            if status:
+                raise BatchError('levitation exited with %d, see %s' % (status, log))
+
+    def import_wiki(self, wiki):
+        """Run the steps of a wiki that aren't done yet."""
+        os.makedirs(wiki['storedir'], exist_ok=True)
+        if not os.path.exists(wiki['repo']):
+            subprocess.run(['git', 'init', '-q', '--bare', wiki['repo']], check=True)
+
+        progfile = os.path.join(wiki['storedir'], 'import-prog')
+        done = set()
+        if os.path.exists(progfile):
+            with open(progfile) as f:
+                done = set(line.rstrip('\n') for line in f)
+
+        steps = [(dump, ['--only-blobs']) for dump in wiki['dumps']]
+        steps.append(('commits', []))
+        steps = [(name, args) for name, args in steps if name not in done]
+        if not steps:
+            self.report('%s: already imported' % wiki['name'])
+            return
+
+        start = time.time()
+        imported = 0
+        for name, args in steps:
+            if name == 'commits':
+                self.step(wiki, args)
+            else:
+                self.step(wiki, args, name)
+                imported += os.path.getsize(name)
+            with open(progfile, 'a') as f:
+                f.write(name + '\n')
+
+        elapsed = max(time.time() - start, 1e-9)
+        with self.lock:
+            self.imported += imported
+        self.report('%s: %.1f MiB of dumps in %.1fs (%.1f MiB/s)' % (
+            wiki['name'], imported / (1 << 20), elapsed, imported / elapsed / (1 << 20)))
+
+    def run(self):
+        """Import all wikis and report. Returns True if none failed."""
+        total = sum(w['bytes'] for w in self.wikis)
+        self.report('Importing %d wikis, %.1f MiB of dumps, with %d workers.' % (
+            len(self.wikis), total / (1 << 20), self.options.WORKERS))
+
+        start = time.time()
+        done = 0
+        with concurrent.futures.ThreadPoolExecutor(self.options.WORKERS) as pool:
+            futures = {pool.submit(self.import_wiki, w): w for w in self.wikis}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                except (BatchError, OSError, subprocess.CalledProcessError) as e:
+                    self.failed.append((futures[future]['name'], e))
+                    self.report('%s: %s' % (futures[future]['name'], e))
+
+        elapsed = max(time.time() - start, 1e-9)
+        self.report('Imported %d wikis, %.1f MiB of dumps in %.1fs (%.1f MiB/s).' % (
+            done, self.imported / (1 << 20), elapsed,
+            self.imported / elapsed / (1 << 20)))
+        for name, error in self.failed:
+            self.report('failed: %s' % name)
+
+        return not self.failed
 
 
 def sanitize(s):
@@ -708,100 +2160,631 @@ def create_path(ns, title, upload, meta):
     else:
         raise ValueError("Unknown directory structure style %s." % meta['options'].DIRSTRUCT)
 
+def commit_command(meta, info, username, comment, filename, dataref, commit_num=None):
+    """Return the fast-import commit command for a revision or upload.
+
+    Args:
+        info: dict, revision information as returned by MetaStore.read.
+        username: string, the name of the author. Not used for IP edits and
+           deleted users.
+        comment: string, the revision comment.
+        filename: string, the path of the page in the repository.
+        dataref: string, how fast-import finds the content, an object id or a
+           mark like ':12'. If it is 'inline', the data command has to follow.
+        commit_num: int, the number of this commit, which the marks of this
+           commit and its parent are derived from. If None, the commit has no
+           mark and continues the branch fast-import is currently on.
+        meta: dict, the meta dict.
+
+    Returns:
+       string, the commit command.
+    """
+    if info['upload']:
+        msg = '%s\n\nLevitation import of an upload for page %d' % (
+            comment, info['page'])
+    else:
+        msg = '%s\n\nLevitation import of page %d rev %d%s.\n' % (
+            comment, info['page'], info['rev'],
+            ' (minor)' if info['minor'] else '')
+
+    if info['isip']:
+        author = info['user']
+        authoruid = 'ip-' + author
+    elif info['isdel']:
+        author = '[deleted user]'
+        authoruid = 'deleted'
+    else:
+        authoruid = 'uid-' + str(info['user'])
+        author = username
+    if meta['options'].AUTHOR_DOMAIN:
+      email = authoruid + '@' + meta['options'].AUTHOR_DOMAIN
+    else:
+      email = authoruid + '@git.' + meta['domain']
+
+    if meta['options'].WIKITIME:
+        committime = info['epoch']
+        offset = '+0000'
+    else:
+        committime = time.time()
+        offset = tzoffsetorzero()
+
+    if commit_num is None:
+        markline = fromline = ''
+    else:
+        markline = 'mark :%d\n' % commit_mark(commit_num)
+        fromline = 'from :%d\n' % commit_mark(commit_num-1) if commit_num > 0 else ''
+
+    return (
+        'commit %s\n' % meta['options'].BRANCH +
+        markline +
+        'author %s <%s> %d +0000\n' % (author, email, info['epoch']) +
+        'committer %s %d %s\n' % (meta['options'].COMMITTER, committime, offset) +
+        'data %d\n%s\n' % (len(bytes(msg, ENCODING)), msg) +
+        fromline +
+        'M 100644 %s %s\n' % (dataref, filename)
+    )
+
+
+def init_segment_worker(meta):
+    """Set up a --jobs worker process with its own handles on the stores."""
+    global SEGMENT_COMMITTER
+    meta.update(open_stores(meta['options']))
+    meta['governor'] = MemoryGovernor(0)
+    SEGMENT_COMMITTER = Committer(meta)
+
+
+def render_segment(infos, commit_num, day):
+    return SEGMENT_COMMITTER.render(infos, commit_num, day)
+
+
+class ExternalSort:
+    """Sorts revision information by time, for --sort.
+
+    Infos are collected in memory. When the governor asks for memory and the
+    buffer is big enough to be worth it (MIN_RUN, or an eighth of the limit if
+    that is more), the collected ones are sorted and spilled as a run of small
+    records. All runs go into one temporary file. Whenever FAN_IN runs of the
+    same level pile up, they are merged into one run of the next level, so
+    the number of runs only grows with the logarithm of the dump size. The
+    final merge reads the infos back from the stores. Ties keep the order
+    the infos were added in, so the order, and with it the commit numbers a
+    checkpoint refers to, is the same with or without spilling.
+
+    Attributes:
+      buffer: list of (epoch, sequence number, info), not spilled yet.
+      runs: list of (offset, count, level) of the runs in the temporary file,
+          highest level first.
+    """
+
+    # L: The datetime
+    # Q: Sequence number, for a stable order
+    # ?: Whether it is an upload
+    # L: The revision or upload id
+    RUN = struct.Struct('=LQ?L')
+    # Smallest buffer worth spilling, in bytes.
+    MIN_RUN = 64 << 20
+    # Number of runs of a level merged into one of the next level.
+    FAN_IN = 16
+    # Records read from a run at a time.
+    CHUNK = 4096
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.buffer = []
+        self.runs = []
+        self.file = None
+        self.added = self.entry = 0
+        self.meta['governor'].register('sort buffer', self.size, self.spill)
+
+    def add(self, info):
+        if not self.entry:
+            # Estimate the memory of one entry, its tuple included.
+            self.entry = 64 + sys.getsizeof(info) + sum(sys.getsizeof(v) for v in info.values())
+        self.buffer.append((info['epoch'], self.added, info))
+        self.added += 1
+        self.meta['governor'].tick()
+
+    def size(self):
+        return len(self.buffer) * self.entry
+
+    def spill(self):
+        """Write the buffer to disk as a sorted run, return the bytes freed."""
+        if self.size() < max(self.meta['governor'].limit // 8, self.MIN_RUN):
+            return 0
+        freed = self.size()
+        self.buffer.sort(key=lambda e: e[:2])
+        self.write_run(((epoch, seq, info['upload'], info['rev'])
+                        for epoch, seq, info in self.buffer), 0)
+        progress('Spilled %d sorted revisions to disk.' % len(self.buffer))
+        self.buffer = []
+
+        while len(self.runs) >= self.FAN_IN and self.runs[-self.FAN_IN][2] == self.runs[-1][2]:
+            merging = self.runs[-self.FAN_IN:]
+            del self.runs[-self.FAN_IN:]
+            self.write_run(heapq.merge(*(self.read_run(offset, count)
+                                         for offset, count, _level in merging)),
+                           merging[0][2] + 1)
+        return freed
+
+    def write_run(self, records, level):
+        """Append sorted (epoch, seq, upload, rev) records as a run."""
+        if not self.file:
+            self.file = tempfile.TemporaryFile()
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        count = 0
+        for record in records:
+            self.file.write(self.RUN.pack(*record))
+            count += 1
+        # Runs are read with pread, which bypasses the write buffer.
+        self.file.flush()
+        self.runs.append((offset, count, level))
+
+    def read_run(self, offset, count):
+        """Generator for the (epoch, seq, upload, rev) records of a run."""
+        end = offset + count * self.RUN.size
+        while offset < end:
+            data = os.pread(self.file.fileno(), min(self.CHUNK * self.RUN.size, end - offset), offset)
+            offset += len(data)
+            yield from self.RUN.iter_unpack(data)
+
+    def read_infos(self, offset, count):
+        stores = {False: self.meta['meta'], True: self.meta['uplo']}
+        for epoch, seq, upload, rev in self.read_run(offset, count):
+            yield epoch, seq, stores[upload].read(rev)
+
+    def __iter__(self):
+        self.meta['governor'].unregister('sort buffer')
+        self.buffer.sort(key=lambda e: e[:2])
+        sources = [self.read_infos(offset, count) for offset, count, _level in self.runs]
+        sources.append(self.buffer)
+        for _epoch, _seq, info in heapq.merge(*sources, key=lambda e: e[:2]):
+            yield info
+        if self.file:
+            self.file.close()
+
+
 class Committer:
+    # Rough memory of the records of one commit in the prefetch ring, in bytes.
+    RECORDS_SIZE = 2048
+    # Never shrink --segment-size below this.
+    MIN_SEGMENT_SIZE = 100
+
     def __init__(self, meta):
         self.meta = meta
-        if tzoffset() == None:
-            progress('warning: using %s as local time offset since your system refuses to tell me the right one;' \
-                'commit (but not author) times will most likely be wrong' % tzoffsetorzero())
+        self.checkpoints = []
+        self.checkpointed = (-1, time.monotonic())
+        # Tells the checkpoint blobs of this run from those of others.
+        self.run = os.urandom(8).hex()
+        self.prefetch = meta['options'].PREFETCH
+        self.segment_size = meta['options'].SEGMENT_SIZE
 
-    def work(self):
-        def gen():
-            """Generator for revision information."""
-            for index in itertools.count(start=0, step=1):
-                info = self.meta['meta'].read(index)
-                if not info:
-                    break
-                if info['exists']:
-                    yield info
-            for index in itertools.count(start=0, step=1):
-                info = self.meta['uplo'].read(index)
+    def all_infos(self, after=None):
+        """Generator for the information of all revisions, then all uploads.
+
+        Args:
+          after: tuple (upload, rev) of the last revision or upload to skip, as
+              recorded in a checkpoint, or None to start at the beginning.
+        """
+        for upload, store in ((False, self.meta['meta']), (True, self.meta['uplo'])):
+            start = 0
+            if after and after[0] == upload:
+                start = after[1] + 1
+            elif after and after[0]:
+                continue
+
+            for index in itertools.count(start=start, step=1):
+                info = store.read(index)
                 if not info:
                     break
                 if info['exists']:
                     yield info
-        if self.meta['options'].SORT:
-            # TODO: Avoid reading all infos into memory, sort them on disk
-            # instead.
-            progress("Reading in all basic revision information. If this uses too much memory, try without --sort.")
-            infos = [info for info in gen()]
-            progress("Sorting basic revision information by time. If this takes too long, try without --sort.")
-            infos.sort(key=lambda x: x['epoch'])
+
+    def selected_pages(self):
+        """Return the set of page ids selected by the subset options.
+
+        Pages can be selected by id, by full title and by namespace (either the
+        namespace id or its name). Titles and namespaces are looked up in the
+        page title store. Returns None if no subset was requested.
+        """
+        options = self.meta['options']
+        if not (options.PAGE_IDS or options.PAGE_TITLES or options.NAMESPACES):
+            return None
+
+        pages = set(options.PAGE_IDS)
+
+        namespaces = set()
+        for ns in options.NAMESPACES:
+            if ns.isdigit():
+                namespaces.add(int(ns))
+            elif ns in self.meta['nstoid']:
+                namespaces.add(self.meta['nstoid'][ns])
+            else:
+                raise ValueError('Unknown namespace %s.' % ns)
+
+        titles = set()
+        for fulltitle in options.PAGE_TITLES:
+            page = Page(self.meta)
+            page.setTitle(fulltitle.replace('_', ' '))
+            titles.add((page.nsid, page.title))
+
+        if namespaces or titles:
+            store = self.meta['page']
+            for id in range(store.count()):
+                data = store.read(id)
+                if data['len'] == 0:
+                    continue
+                if data['flags'] in namespaces or (data['flags'], data['text']) in titles:
+                    pages.add(id)
+
+        return pages
+
+    def selected_infos(self, pages):
+        """Return the information of all revisions and uploads of some pages.
+
+        The page index is built from the stores first if it is still empty or
+        the stores changed since it was built.
+        Revisions come before uploads, each ordered by id, like in all_infos.
+        """
+        infos = []
+        for store, index in ((self.meta['meta'], self.meta['pidx']),
+                             (self.meta['uplo'], self.meta['upix'])):
+            if index.stale(store) or self.meta['options'].REBUILD_INDEX:
+                progress('Building page index. This reads all revision information once.')
+                index.build(store)
+
+            revs = []
+            for page in pages:
+                revs.extend(index.revisions(page))
+            revs.sort()
+
+            for rev in revs:
+                info = store.read(rev)
+                if info and info['exists']:
+                    infos.append(info)
+
+        return infos
+
+    def selection(self):
+        """Return the options that decide which commits are written in which
+        order, to tell whether a checkpoint belongs to this run."""
+        options = self.meta['options']
+        return (options.SORT, options.BRANCH, sorted(options.PAGE_IDS),
+                sorted(options.PAGE_TITLES), sorted(options.NAMESPACES))
+
+    def checkpoint(self, commit_num, info):
+        """Make fast-import save its state and remember where we are.
+
+        The checkpoint only becomes durable once fast-import got to the
+        command, which is some time after we sent it. So the latest few
+        checkpoints are kept. After each one, a blob that is unique to this
+        run and checkpoint is written with CHECKPOINT_MARK, and
+        load_checkpoint picks the checkpoint whose blob the exported marks
+        file has. Marks of other runs in the file can't be mistaken for it.
+        """
+        token = bytes('levitation checkpoint %s %d\n' % (self.run, commit_num), ENCODING)
+        self.checkpoints.append({
+            'selection':  self.selection(),
+            'commit_num': commit_num,
+            'upload':     info['upload'],
+            'rev':        info['rev'],
+            'epoch':      info['epoch'],
+            'sha':        hashlib.sha1(b'blob %d\0' % len(token) + token).hexdigest(),
+            })
+        del self.checkpoints[:-CHECKPOINTS_KEPT]
+
+        # Replace the file in one go, so a crash leaves the old one intact.
+        # It is written first, so it knows every checkpoint blob fast-import
+        # might have seen.
+        ckptfile = self.meta['options'].CKPTFILE
+        with open(ckptfile + '.tmp', 'wb') as f:
+            pickle.dump(self.checkpoints, f)
+        os.replace(ckptfile + '.tmp', ckptfile)
+
+        out('checkpoint\n')
+        out('blob\nmark :%d\ndata %d\n' % (CHECKPOINT_MARK, len(token)))
+        bytes_out(token + b'\n')
+        progress('checkpoint after commit %d' % commit_num)
+        flush_out()
+
+        self.checkpointed = (commit_num, time.monotonic())
+
+    def checkpoint_due(self, commit_num):
+        options = self.meta['options']
+        last_num, last_time = self.checkpointed
+        if options.CHECKPOINT_EVERY > 0 and commit_num - last_num >= options.CHECKPOINT_EVERY:
+            return True
+        if options.CHECKPOINT_INTERVAL > 0 and time.monotonic() - last_time >= options.CHECKPOINT_INTERVAL:
+            return True
+        return False
+
+    def load_checkpoint(self):
+        """Return the latest durable checkpoint, or None if there is none.
+
+        Raises ValueError if the checkpoint was written by a run with other
+        ordering or page selection options.
+        """
+        options = self.meta['options']
+        try:
+            with open(options.CKPTFILE, 'rb') as f:
+                checkpoints = pickle.load(f)
+        except (FileNotFoundError, EOFError):
+            return None
+
+        sha = None
+        prefix = b':%d ' % CHECKPOINT_MARK
+        try:
+            with open(commit_markfile(options), 'rb') as f:
+                for line in f:
+                    if line.startswith(prefix):
+                        sha = line[len(prefix):].strip().decode('ascii')
+        except FileNotFoundError:
+            pass
+
+        for i in reversed(range(len(checkpoints))):
+            if checkpoints[i].get('sha') == sha:
+                if checkpoints[i]['selection'] != self.selection():
+                    raise ValueError('%s was written with other ordering or page selection options.' % options.CKPTFILE)
+                self.checkpoints = checkpoints[:i+1]
+                return checkpoints[i]
+
+        return None
+
+    def fetch(self, info):
+        """Read the records a commit needs from the stores, as a dict."""
+        if info['upload']:
+            comm, blob = self.meta['upco'], self.meta['uphs']
         else:
-            infos = gen()
+            comm, blob = self.meta['comm'], self.meta['hash']
 
-        commit_num = -1
-        day = ''
-        for info in infos:
-            commit_num += 1
+        records = {
+            'page': self.meta['page'].read(info['page']),
+            'comm': comm.read(info['rev']),
+            'blob': blob.read(info['rev']),
+            'user': None,
+            }
+        if not (info['isip'] or info['isdel']):
+            records['user'] = self.meta['user'].read(info['user'])
+
+        return records
+
+    def fetched(self, infos):
+        """Generator for (info, records) pairs, see fetch.
+
+        With --prefetch, the records of the next few commits are read by a pool
+        of threads while the current one is written. They wait in a ring
+        buffer in commit order. Since reads release the GIL, disk latency is
+        hidden behind I/O parallelism, which pays off when --sort makes reads
+        jump all over the stores. The governor can make the ring shorter.
+        """
+        options = self.meta['options']
+        if self.prefetch <= 0:
+            for info in infos:
+                yield info, self.fetch(info)
+            return
+
+        ring = collections.deque()
+
+        def shrink():
+            if self.prefetch == 1:
+                return 0
+            self.prefetch //= 2
+            return max(len(ring) - self.prefetch, 0) * self.RECORDS_SIZE
+
+        governor = self.meta['governor']
+        governor.register('prefetch ring', lambda: len(ring) * self.RECORDS_SIZE, shrink)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(options.PREFETCH_THREADS) as pool:
+                for info in infos:
+                    ring.append((info, pool.submit(self.fetch, info)))
+                    while len(ring) > self.prefetch:
+                        info, records = ring.popleft()
+                        yield info, records.result()
+                while ring:
+                    info, records = ring.popleft()
+                    yield info, records.result()
+        finally:
+            governor.unregister('prefetch ring')
+
+    def commit_text(self, info, commit_num, records):
+        """Return the commit command for a revision or upload."""
+        page = records['page']
+        filename = create_path(page['flags'], page['text'], info['upload'], self.meta)
+        if info['upload']:
+            blob_mark = upload_mark(info['rev'])
+        else:
+            blob_mark = revision_mark(info['rev'])
+
+        # Blobs from before object ids were stored only have a mark.
+        blob = records['blob']
+        dataref = blob['sha'] if blob else ':%d' % blob_mark
+        options = self.meta['options']
+        if not blob and options.GIT_DIR and commit_markfile(options) != options.MARKFILE \
+                and not options.BLOB_MARKS:
+            raise ValueError('%s %d has no object id in the information files, use --blob-marks to find its blob by mark.' % (
+                'Upload' if info['upload'] else 'Revision', info['rev']))
+
+        username = records['user']['text'] if records['user'] else None
 
-            # Update progress indicator.
+        return commit_command(self.meta, info, username, records['comm']['text'],
+            filename, dataref, commit_num)
+
+    def render(self, infos, commit_num, day):
+        """Return the output for a segment of consecutive commits, as bytes.
+
+        Args:
+          infos: list of the revision information of the commits.
+          commit_num: int, the number of the commit before the segment.
+          day: string, the day of the commit before the segment, so progress
+              lines only appear when the day changes, like in a serial run.
+        """
+        parts = []
+        for info, records in self.fetched(infos):
+            commit_num += 1
             if day != info['day']:
                 day = info['day']
-                progress('   ' + day)
-
-            # Calculate all the data needed for the commit.
-            page = self.meta['page'].read(info['page'])
-            filename = create_path(page['flags'], page['text'], info['upload'], self.meta)
-            if info['upload']:
-                comm = self.meta['upco'].read(info['rev'])
-                msg = '%s\n\nLevitation import of an upload for page %d' % (
-                    comm['text'], info['page'])
-                blob_mark = upload_mark(info['rev'])
-            else:
-                comm = self.meta['comm'].read(info['rev'])
-                msg = '%s\n\nLevitation import of page %d rev %d%s.\n' % (
-                    comm['text'], info['page'], info['rev'],
-                    ' (minor)' if info['minor'] else '')
-                blob_mark = revision_mark(info['rev'])
-
-            if info['isip']:
-                author = info['user']
-                authoruid = 'ip-' + author
-            elif info['isdel']:
-                author = '[deleted user]'
-                authoruid = 'deleted'
-            else:
-                authoruid = 'uid-' + str(info['user'])
-                author = self.meta['user'].read(info['user'])['text']
-            if self.meta['options'].AUTHOR_DOMAIN:
-              email = authoruid + '@' + self.meta['options'].AUTHOR_DOMAIN
-            else:
-              email = authoruid + '@git.' + self.meta['domain']
+                parts.append('progress    %s\n' % day)
+            parts.append(self.commit_text(info, commit_num, records))
 
-            if self.meta['options'].WIKITIME:
-                committime = info['epoch']
-                offset = '+0000'
-            else:
-                committime = time.time()
-                offset = tzoffsetorzero()
-
-            # Write out the commit.
-            fromline = 'from :%d\n' % commit_mark(commit_num-1) if commit_num > 0 else ''
-            out(
-                'commit refs/heads/master\n' +
-                'mark :%d\n' % commit_mark(commit_num) +
-                'author %s <%s> %d +0000\n' % (author, email, info['epoch']) +
-                'committer %s %d %s\n' % (self.meta['options'].COMMITTER, committime, offset) +
-                'data %d\n%s\n' % (len(bytes(msg, ENCODING)), msg) +
-                fromline +
-                'M 100644 :%d %s\n' % (blob_mark, filename)
-            )
+        return bytes(''.join(parts), ENCODING)
+
+    def segments(self, infos, commit_num):
+        """Generator cutting the commits into segments for render_segment."""
+        infos = iter(infos)
+        day = ''
+        while True:
+            segment = list(itertools.islice(infos, self.segment_size))
+            if not segment:
+                return
+            yield (segment, commit_num, day)
+            commit_num += len(segment)
+            day = segment[-1]['day']
+
+    def write_segments(self, infos, commit_num):
+        """Render segments of commits in worker processes, write them in order.
+
+        Every segment is handed the number of the commit before it, so the marks
+        and 'from' lines match up across segments. At most two segments per
+        worker are in flight, so the workers can't run away from the output.
+        The governor can make the segments smaller.
+
+        Returns:
+          tuple (commit_num, info) of the last commit written, or
+          (commit_num, None) if there were none.
+        """
+        options = self.meta['options']
+        worker_meta = {k: self.meta[k] for k in ('options', 'domain', 'nstoid', 'idtons', 'max_upload')}
+        pending = collections.deque()
+        info = None
+        # Output bytes per commit, to estimate the memory of pending segments.
+        written = commits = 0
+
+        def size():
+            per_commit = written // max(commits, 1)
+            return sum(len(segment) for _result, (segment, _n, _d) in pending) * per_commit
+
+        def shrink():
+            if self.segment_size <= self.MIN_SEGMENT_SIZE:
+                return 0
+            self.segment_size = max(self.segment_size // 2, self.MIN_SEGMENT_SIZE)
+            return size() // 2
+
+        governor = self.meta['governor']
+        governor.register('commit segments', size, shrink)
+        with multiprocessing.Pool(options.JOBS, init_segment_worker, (worker_meta,)) as pool:
+            segments = self.segments(infos, commit_num)
+            while True:
+                for segment in itertools.islice(segments, 2 * options.JOBS - len(pending)):
+                    pending.append((pool.apply_async(render_segment, segment), segment))
+                if not pending:
+                    break
+
+                result, (segment, commit_num, day) = pending.popleft()
+                output = result.get()
+                bytes_out(output)
+                commit_num += len(segment)
+                info = segment[-1]
+                written += len(output)
+                commits += len(segment)
+                governor.check()
+
+                if self.checkpoint_due(commit_num):
+                    self.checkpoint(commit_num, info)
+
+        governor.unregister('commit segments')
+        return commit_num, info
+
+    def work(self):
+        if tzoffset() == None:
+            progress('warning: using %s as local time offset since your system refuses to tell me the right one;' \
+                'commit (but not author) times will most likely be wrong' % tzoffsetorzero())
+
+        options = self.meta['options']
+        checkpoint = None
+        if options.RESUME:
+            checkpoint = self.load_checkpoint()
+            if not checkpoint:
+                progress('No checkpoint found in %s and %s, starting from the first commit.' % (
+                    options.CKPTFILE, commit_markfile(options)))
+
+        pages = self.selected_pages()
+        if pages is not None:
+            progress('Exporting %d selected pages to %s.' % (len(pages), self.meta['options'].BRANCH))
+            infos = self.selected_infos(pages)
+        elif checkpoint and not options.SORT:
+            infos = self.all_infos(after=(checkpoint['upload'], checkpoint['rev']))
+        else:
+            infos = self.all_infos()
+
+        if self.meta['options'].SORT:
+            progress("Reading in all basic revision information. If this uses too much memory, try --memory-limit.")
+            sorter = ExternalSort(self.meta)
+            for info in infos:
+                sorter.add(info)
+            progress("Sorting basic revision information by time. If this takes too long, try without --sort.")
+            infos = iter(sorter)
+
+        commit_num = -1
+        if checkpoint:
+            commit_num = checkpoint['commit_num']
+            self.checkpointed = (commit_num, time.monotonic())
+            if pages is not None or options.SORT:
+                infos = itertools.islice(infos, commit_num + 1, None)
+            progress('Resuming after commit %d (rev %d from %s).' % (
+                commit_num, checkpoint['rev'],
+                time.strftime('%Y-%m-%d', time.gmtime(checkpoint['epoch']))))
+
+        info = None
+        if options.JOBS > 1:
+            commit_num, info = self.write_segments(infos, commit_num)
+        else:
+            day = ''
+            for info, records in self.fetched(infos):
+                commit_num += 1
+
+                # Update progress indicator.
+                if day != info['day']:
+                    day = info['day']
+                    progress('   ' + day)
+
+                out(self.commit_text(info, commit_num, records))
+                self.meta['governor'].tick()
+
+                if self.checkpoint_due(commit_num):
+                    self.checkpoint(commit_num, info)
+
+        # Mark the end, so that resuming a finished run does nothing.
+        checkpointing = options.CHECKPOINT_EVERY > 0 or options.CHECKPOINT_INTERVAL > 0
+        if checkpointing and info and self.checkpointed[0] != commit_num:
+            self.checkpoint(commit_num, info)
+
+
+def open_stores(options):
+    """Return a dict of all information files, opened."""
+    return {
+        'meta': MetaStore(options.METAFILE),
+        'comm': StringStore(options.COMMFILE),
+        'uplo': MetaStore(options.UPLOFILE),
+        'upco': StringStore(options.UPCOFILE),
+        'user': StringStore(options.USERFILE),
+        'page': StringStore(options.PAGEFILE),
+        'hash': HashStore(options.HASHFILE),
+        'uphs': HashStore(options.UPHASHFILE),
+        'pidx': PageIndex(options.IDXFILE),
+        'upix': PageIndex(options.UPIDXFILE),
+        }
 
 
 class LevitationImport:
     def __init__(self):
         (options, _args) = self.parse_args(sys.argv[1:])
+        global REPORT
+        REPORT = options.PRESCAN or options.PLAN or options.VERIFY
+        if options.BATCH:
+            if not Batch(options).run():
+                sys.exit(1)
+            return
+
         # Select parser. Prefer lxml, fall back to Expat.
         parser = None
         try:
@@ -817,7 +2800,7 @@ class LevitationImport:
             parser = ExpatHandler
             progress('Using Expat parser.')
 
-        if options.OVERWRITE:
+        if options.OVERWRITE and not options.SINGLE_PASS:
             # clear the info files
             files = [
                 options.PKLFILE,
@@ -827,6 +2810,15 @@ class LevitationImport:
                 options.UPCOFILE,
                 options.USERFILE,
                 options.PAGEFILE,
+                options.HASHFILE,
+                options.UPHASHFILE,
+                options.IDXFILE,
+                options.IDXFILE + '-prev',
+                options.IDXFILE + '-stamp',
+                options.UPIDXFILE,
+                options.UPIDXFILE + '-prev',
+                options.UPIDXFILE + '-stamp',
+                options.CKPTFILE,
             ]
             for each in files:
                 with open(each, 'wb+') as f:
@@ -834,42 +2826,64 @@ class LevitationImport:
 
         meta = {
             'options': options,
-            'meta': MetaStore(options.METAFILE),
-            'comm': StringStore(options.COMMFILE),
-            'uplo': MetaStore(options.UPLOFILE),
-            'upco': StringStore(options.UPCOFILE),
-            'user': StringStore(options.USERFILE),
-            'page': StringStore(options.PAGEFILE),
             'domain': 'unknown.invalid',
             'nstoid': {},
             'idtons': {},
             'max_upload': 0,
+            'governor': MemoryGovernor(parse_size(options.MEMORY_LIMIT)),
             }
         pkl_keys = ['domain', 'nstoid', 'idtons', 'max_upload']
 
+        # A single pass import keeps everything in memory, a plan uses
+        # temporary files.
+        stores = {}
+        if not (options.SINGLE_PASS or options.PLAN):
+            stores = open_stores(options)
+            meta.update(stores)
+
+            try:
+                with open(options.PKLFILE, 'rb') as f:
+                    data = pickle.load(f)
+                meta.update((k, data[k]) for k in pkl_keys if k in data)
+            except (FileNotFoundError, EOFError):
+                pass
+
+        fastimport = None
+        if options.GIT_DIR and not (options.PLAN or options.PRESCAN or options.VERIFY):
+            fastimport = FastImport(options)
+        verified = True
         try:
-            with open(options.PKLFILE, 'rb') as f:
-                data = pickle.load(f)
-            meta.update((k, data[k]) for k in pkl_keys if k in data)
-        except (FileNotFoundError, EOFError):
-            pass
-
-        if options.ONLYBLOB:
-            progress('Step 1: Creating blobs.')
-            BlobWriter(meta).parse(parser)
-            with open(options.PKLFILE, 'wb') as f:
-                pickle.dump({k: meta[k] for k in pkl_keys}, f)
-        else:
-            progress('Step 2: Writing commits.')
-            Committer(meta).work()
+            if options.VERIFY:
+                verified = Verifier(meta).run()
+            elif options.PLAN:
+                Planner(meta).run(parser)
+            elif options.PRESCAN:
+                scanner = PreScanner()
+                scanner.scan(sys.stdin.buffer)
+                scanner.report()
+                if not options.SINGLE_PASS:
+                    scanner.preallocate(meta)
+            elif options.SINGLE_PASS:
+                progress('Creating blobs and commits in a single pass.')
+                BlobWriter(meta).parse(parser)
+            elif options.ONLYBLOB:
+                progress('Step 1: Creating blobs.')
+                BlobWriter(meta).parse(parser)
+                with open(options.PKLFILE, 'wb') as f:
+                    pickle.dump({k: meta[k] for k in pkl_keys}, f)
+            else:
+                progress('Step 2: Writing commits.')
+                Committer(meta).work()
+            meta['governor'].report()
+        finally:
+            if fastimport:
+                fastimport.close()
 
+        for store in stores.values():
+            store.close()
 
-        meta['meta'].fh.close()
-        meta['comm'].fh.close()
-        meta['uplo'].fh.close()
-        meta['upco'].fh.close()
-        meta['user'].fh.close()
-        meta['page'].fh.close()
+        if not verified:
+            sys.exit(1)
 
 
     def parse_args(self, args):
@@ -924,14 +2938,150 @@ class LevitationImport:
                 help="File for storing page information (257 bytes/page) (default: import-page)",
                 default="import-page")
 
+        parser.add_option("--hashfile", dest="HASHFILE", metavar="FILE",
+                help="File for storing the git object id and size of revisions (28 bytes/rev) (default: import-hash)",
+                default="import-hash")
+
+        parser.add_option("--uphashfile", dest="UPHASHFILE", metavar="FILE",
+                help="File for storing the git object id and size of uploads (28 bytes/upload) (default: import-uphs)",
+                default="import-uphs")
+
+        parser.add_option("--idxfile", dest="IDXFILE", metavar="FILE",
+                help="File for storing the page to revisions index, FILE-prev is used as well (4 bytes/page and rev) (default: import-pidx)",
+                default="import-pidx")
+
+        parser.add_option("--upidxfile", dest="UPIDXFILE", metavar="FILE",
+                help="File for storing the page to uploads index, FILE-prev is used as well (4 bytes/page and upload) (default: import-upix)",
+                default="import-upix")
+
+        parser.add_option("--page-id", dest="PAGE_IDS", metavar="INT",
+                help="Only write commits for the page with this id. Can be given multiple times.",
+                action="append", type="int", default=[])
+
+        parser.add_option("--page-title", dest="PAGE_TITLES", metavar="TITLE",
+                help="Only write commits for the page with this full title. Can be given multiple times.",
+                action="append", default=[])
+
+        parser.add_option("--namespace", dest="NAMESPACES", metavar="NS",
+                help="Only write commits for pages in this namespace (id or name). Can be given multiple times.",
+                action="append", default=[])
+
+        parser.add_option("--rebuild-index", dest="REBUILD_INDEX",
+                help="Rebuild the page index before writing the commits of selected pages.", action="store_true",
+                default=False)
+
+        parser.add_option("-b", "--branch", dest="BRANCH", metavar="REF",
+                help="Branch to write the commits to (default: refs/heads/master)",
+                default="refs/heads/master")
+
+        parser.add_option("-g", "--git-dir", dest="GIT_DIR", metavar="REPO",
+                help="Run git fast-import on this repository instead of writing to stdout",
+                default=None)
+
+        parser.add_option("--markfile", dest="MARKFILE", metavar="FILE",
+                help="File for the git fast-import marks, used with --git-dir and --resume (default: import-mark)",
+                default="import-mark")
+
+        parser.add_option("--blob-marks", dest="BLOB_MARKS",
+                help="With --git-dir, let an export of selected pages import the marks of the full import, "
+                     "for blobs written before object ids were stored (see --hashfile).",
+                action="store_true", default=False)
+
+        parser.add_option("--max-pack-size", dest="MAX_PACK_SIZE", metavar="SIZE",
+                help="Maximum size of the packs git fast-import writes, with --git-dir (default: 4g)",
+                default="4g")
+
+        parser.add_option("--depth", dest="PACK_DEPTH", metavar="INT",
+                help="Maximum delta depth git fast-import uses, with --git-dir. Revisions of a page are written in a row, so long chains pay off (default: 100)",
+                default=100, type="int")
+
+        parser.add_option("--pipe-size", dest="PIPE_SIZE", metavar="BYTES",
+                help="Size of the pipe buffer to git fast-import, with --git-dir (default: 1048576)",
+                default=1048576, type="int")
+
+        parser.add_option("-j", "--jobs", dest="JOBS", metavar="INT",
+                help="Number of processes generating commits (default: 1)",
+                default=1, type="int")
+
+        parser.add_option("--segment-size", dest="SEGMENT_SIZE", metavar="INT",
+                help="Number of commits a --jobs process generates at a time (default: 10000)",
+                default=10000, type="int")
+
+        parser.add_option("--prefetch", dest="PREFETCH", metavar="INT",
+                help="Number of commits to read comments, titles and authors for ahead of time, 0 to disable (default: 0)",
+                default=0, type="int")
+
+        parser.add_option("--prefetch-threads", dest="PREFETCH_THREADS", metavar="INT",
+                help="Number of threads reading ahead with --prefetch (default: 8)",
+                default=8, type="int")
+
+        parser.add_option("--checkpoint-every", dest="CHECKPOINT_EVERY", metavar="INT",
+                help="Make git fast-import checkpoint after this many commits, 0 to disable (default: 0)",
+                default=0, type="int")
+
+        parser.add_option("--checkpoint-interval", dest="CHECKPOINT_INTERVAL", metavar="SECONDS",
+                help="Make git fast-import checkpoint after this many seconds, 0 to disable (default: 0)",
+                default=0, type="int")
+
+        parser.add_option("--ckptfile", dest="CKPTFILE", metavar="FILE",
+                help="File for storing where the commit checkpoints were (default: import-ckpt)",
+                default="import-ckpt")
+
+        parser.add_option("--resume", dest="RESUME",
+                help="Continue writing commits after the last checkpoint that is in the marks file (see --markfile).",
+                action="store_true", default=False)
+
         parser.add_option("--no-lxml", dest="NOLXML",
                 help="Do not use the lxml parser, even if it is available", action="store_true",
                 default=False)
 
+        parser.add_option("--pipeline", dest="PIPELINE",
+                help="Parse, write metadata and write blobs on separate threads.", action="store_true",
+                default=False)
+
+        parser.add_option("--queue-size", dest="QUEUE_SIZE", metavar="INT",
+                help="Number of revisions queued between pipeline stages (default: 64)",
+                default=64, type="int")
+
+        parser.add_option("--memory-limit", dest="MEMORY_LIMIT", metavar="SIZE",
+                help="Keep the memory of this process below SIZE (like 512M or 4G) by shrinking the --sort buffer, "
+                     "pipeline queues, prefetch ring and --jobs segments, and spilling to temporary files in $TMPDIR "
+                     "(default: 0, no limit)",
+                default="0")
+
         parser.add_option("--only-blobs", dest="ONLYBLOB",
                 help="Do not do commit yet. More files are expected.", action="store_true",
                 default=False)
 
+        parser.add_option("--prescan", dest="PRESCAN",
+                help="Only scan the dump for the highest ids and the revisions and text per namespace, then preallocate the information files.",
+                action="store_true", default=False)
+
+        parser.add_option("--plan", dest="PLAN",
+                help="Only estimate disk, memory and time needed to import the dump, from a sample of its pages.",
+                action="store_true", default=False)
+
+        parser.add_option("--plan-fraction", dest="PLAN_FRACTION", metavar="FLOAT",
+                help="Fraction of pages to sample for --plan (default: 0.01)",
+                default=0.01, type="float")
+
+        parser.add_option("--verify", dest="VERIFY",
+                help="Only check that all revisions in the information files, or those of the selected pages, made it into the repository "
+                     "(see --git-dir, --branch, --page-id, --page-title and --namespace).",
+                action="store_true", default=False)
+
+        parser.add_option("--single-pass", dest="SINGLE_PASS",
+                help="Write each revision as a commit right away, in dump order. No information files or marks are used.",
+                action="store_true", default=False)
+
+        parser.add_option("--batch", dest="BATCH", metavar="FILE",
+                help="Import all wikis listed in the JSON manifest FILE, see the README.",
+                default=None)
+
+        parser.add_option("--workers", dest="WORKERS", metavar="INT",
+                help="Number of wikis imported at once by --batch (default: half the CPUs)",
+                default=max((os.cpu_count() or 2) // 2, 1), type="int")
+
         parser.add_option("--overwrite", dest="OVERWRITE",
                 help="Overwrite information files", action="store_true",
                 default=False)